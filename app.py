@@ -1,4 +1,4 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, HTTPException
 import telebot
 import ollama
 import threading
@@ -7,12 +7,22 @@ import os
 import sqlite3
 import json
 import logging
-import tempfile
-from typing import Dict, Any, Optional, List
+import hashlib
+import hmac
+import re
+import time
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Callable, Tuple, Sequence
 from dotenv import load_dotenv
-import whisper
+from faster_whisper import WhisperModel
 import subprocess
+import numpy as np
 import imageio_ffmpeg as ffmpeg
+import requests
+from requests.adapters import HTTPAdapter
 
 # ⚙️ Configuração de logging
 logging.basicConfig(
@@ -25,9 +35,40 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen3:4b")
+# Q4_K_M por padrão (menos banda de memória por token); para respostas mais
+# precisas use a variante Q8_0, ex.: OLLAMA_MODEL=qwen3:4b-q8_0
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen3:4b-q4_K_M")
+# Mesmas opções em todas as chamadas: mudar num_ctx faz o Ollama recarregar o modelo
+OLLAMA_OPTIONS = {"num_ctx": 2048, "num_gpu": 999, "num_thread": os.cpu_count() or 1}
 BACKGROUND = os.getenv("BACKGROUND", os.getenv("Background", ""))
 BANCO_SCHEMA = os.getenv("BANCO", os.getenv("banco", ""))
+BANCO_SCHEMA_HASH = hashlib.sha256(BANCO_SCHEMA.encode()).hexdigest()
+# URL pública do servidor para o webhook do Telegram (sem ela, usa polling)
+PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")
+# Auto-reload só em desenvolvimento; vários workers só fazem sentido com webhook
+RELOAD = os.getenv("DEV_RELOAD") == "1"
+WORKERS = int(os.getenv("WORKERS", "1"))
+
+# Streaming da resposta no Telegram: edita a mensagem a cada N tokens ou intervalo (s)
+STREAM_EDIT_TOKENS = 40
+STREAM_EDIT_INTERVALO = 1.0
+# Tentativas da edição final quando o Telegram responde 429
+EDIT_TENTATIVAS = 3
+
+# Agrupamento de perguntas /sql simultâneas em uma única chamada ao Ollama
+LOTE_SQL_MAX = 8
+LOTE_SQL_JANELA = 0.05
+# Threads dos handlers do bot; precisa ser maior que o lote para ele poder encher
+BOT_THREADS = max(int(os.getenv("BOT_THREADS", "16")), LOTE_SQL_MAX + 1)
+
+# Áudios abaixo destes limites não passam pelo Whisper
+VOZ_DURACAO_MINIMA = 1  # segundos
+VOZ_RMS_MINIMO = 1e-3
+# Limite de duração transcrita (s); limita a memória do Whisper por áudio
+VOZ_DURACAO_MAXIMA = 120
+TAXA_AMOSTRAGEM = 16000
+# Tempo máximo da conversão do áudio pelo ffmpeg (s)
+FFMPEG_TIMEOUT = 30
 
 # 🔧 Configuração do ffmpeg para Whisper
 FFMPEG_EXE = None
@@ -60,29 +101,106 @@ except Exception as e:
 if not TELEGRAM_TOKEN:
     raise ValueError("TELEGRAM_TOKEN não encontrado nas variáveis de ambiente!")
 
-# 🚀 Inicializa serviços
-try:
-    model = whisper.load_model("tiny")
-    logger.info("Modelo Whisper carregado com sucesso")
-except Exception as e:
-    logger.error(f"Erro ao carregar modelo Whisper: {e}")
-    raise
+# Segredo enviado pelo Telegram no header de cada update do webhook. Derivado do
+# token quando não configurado, para ser igual em todos os workers
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest()
 
+# 🚀 Inicializa serviços
 app = FastAPI(title="Servidor Ollama Tools + Bot Telegram")
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
+
+# Sessão HTTP compartilhada com pool de conexões para a API do Telegram
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=2))
+telebot.apihelper.session = _session
+telebot.apihelper.CONNECT_TIMEOUT = 5
+telebot.apihelper.READ_TIMEOUT = 30
+
+bot = telebot.TeleBot(TELEGRAM_TOKEN, num_threads=BOT_THREADS)
+
+
+# Whisper carregado só no primeiro uso, uma vez por processo
+_ASR_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _carregar_asr() -> WhisperModel:
+    try:
+        asr = WhisperModel("tiny", device="cpu", compute_type="int8", cpu_threads=os.cpu_count() or 0)
+        logger.info("Modelo Whisper carregado com sucesso")
+        return asr
+    except Exception as e:
+        logger.error(f"Erro ao carregar modelo Whisper: {e}")
+        raise
+
+
+def get_asr() -> WhisperModel:
+    """Retorna o modelo Whisper do processo, carregando-o se necessário."""
+    # O lock evita que duas threads carreguem o modelo ao mesmo tempo
+    with _ASR_LOCK:
+        return _carregar_asr()
+
+
+@app.on_event("startup")
+def carregar_whisper():
+    # Aquece o modelo antes do primeiro áudio
+    get_asr()
+
+
+@app.on_event("startup")
+def carregar_ollama():
+    # Garante o modelo local; falha aqui (offline, tag criada localmente) não impede o aquecimento
+    try:
+        status_anterior = None
+        for progresso in ollama.pull(OLLAMA_MODEL, stream=True):
+            if progresso.get("status") != status_anterior:
+                status_anterior = progresso.get("status")
+                logger.info(f"ollama pull {OLLAMA_MODEL}: {status_anterior}")
+    except Exception as e:
+        logger.warning(f"Não foi possível baixar o modelo Ollama: {e}")
+
+    # Pré-carrega o modelo do Ollama e o mantém residente (sem cold start no primeiro /sql)
+    try:
+        ollama.chat(
+            model=OLLAMA_MODEL,
+            messages=[{"role": "user", "content": "ok"}],
+            options=OLLAMA_OPTIONS,
+            keep_alive=-1
+        )
+        logger.info(f"Modelo Ollama pré-carregado: {OLLAMA_MODEL}")
+    except Exception as e:
+        logger.warning(f"Não foi possível pré-carregar o modelo Ollama: {e}")
 
 # 💾 Banco de dados
 DB_PATH = "Teste.db"
-with sqlite3.connect(DB_PATH) as conn:
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS teste (
-            Id INTEGER PRIMARY KEY AUTOINCREMENT,
-            Nome TEXT,
-            Idade INTEGER
-        )
-    """)
-    conn.commit()
+
+# Conexão única reaproveitada por todas as queries (autocommit + WAL)
+_CONN = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+_CONN.execute("PRAGMA journal_mode=WAL")
+_CONN.execute("PRAGMA synchronous=NORMAL")
+_CONN.execute("PRAGMA temp_store=MEMORY")
+_LOCK = threading.Lock()
+
+_CONN.execute("""
+    CREATE TABLE IF NOT EXISTS teste (
+        Id INTEGER PRIMARY KEY AUTOINCREMENT,
+        Nome TEXT,
+        Idade INTEGER
+    )
+""")
+
+# Cache persistente das SQLs geradas pelo Ollama, em arquivo próprio: as queries
+# geradas rodam em _CONN e não alcançam este banco
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "cache_sql.db")
+_CACHE_CONN = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False, isolation_level=None)
+_CACHE_CONN.execute("PRAGMA journal_mode=WAL")
+_CACHE_CONN.execute("PRAGMA synchronous=NORMAL")
+_CACHE_CONN.execute("""
+    CREATE TABLE IF NOT EXISTS cache (
+        hash TEXT PRIMARY KEY,
+        sql TEXT
+    )
+""")
+_CACHE_LOCK = threading.Lock()
 
 
 # ======================================================
@@ -101,25 +219,69 @@ def seguro_json(obj: Any) -> Dict[str, Any]:
     return {"resposta": str(obj)}
 
 
+# BEGIN/COMMIT/END gerados pelo modelo: a transação já é aberta por executar_sql
+_TRANSACAO_RE = re.compile(r"^(BEGIN|COMMIT|END)(\s+\w+)?\s*;$", re.IGNORECASE)
+
+
+def _separar_comandos(query: str) -> List[str]:
+    """Separa a query em comandos completos, cada um terminado em ';'.
+
+    Usa sqlite3.complete_statement, então ';' dentro de strings, comentários
+    ou triggers não quebra o comando.
+    """
+    comandos = []
+    atual = ""
+    partes = query.split(";")
+    for i, parte in enumerate(partes):
+        atual += parte if i == len(partes) - 1 else parte + ";"
+        if i < len(partes) - 1 and not sqlite3.complete_statement(atual):
+            continue
+        if atual.strip(" \t\r\n;"):
+            comando = atual.strip()
+            comandos.append(comando if comando.endswith(";") else comando + ";")
+        atual = ""
+    return comandos
+
+
+def _script_em_lote(query: str) -> Optional[str]:
+    """Monta o script transacional para vários comandos sem SELECT.
+
+    Retorna None quando a query tem um único comando (ou algum SELECT).
+    """
+    comandos = _separar_comandos(query)
+    if len(comandos) < 2 or any(c[:6].casefold() == "select" for c in comandos):
+        return None
+    comandos = [c for c in comandos if not _TRANSACAO_RE.match(c)]
+    return "BEGIN;\n" + "\n".join(comandos) + "\nCOMMIT;"
+
+
 def executar_sql(query: str) -> Dict[str, Any]:
     """Executa uma query SQL e retorna o resultado."""
     if not query or not query.strip():
         return {"erro": "Query vazia"}
     
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            query_upper = query.strip().upper()
-            
-            if query_upper.startswith("SELECT"):
-                cur.execute(query)
+        with _LOCK:
+            script = _script_em_lote(query)
+            if script:
+                # Vários comandos (ex.: INSERTs em lote): uma transação, um único commit
+                try:
+                    _CONN.executescript(script)
+                except sqlite3.Error:
+                    if _CONN.in_transaction:
+                        _CONN.execute("ROLLBACK")
+                    raise
+                return {"query": query, "status": "Executado com sucesso"}
+
+            cur = _CONN.execute(query)
+
+            # description só é preenchido em comandos que retornam linhas (SELECT)
+            if cur.description is not None:
                 resultado = cur.fetchall()
-                colunas = [desc[0] for desc in cur.description] if cur.description else []
+                colunas = tuple(desc[0] for desc in cur.description)
                 return {"query": query, "colunas": colunas, "resultado": resultado}
-            else:
-                cur.execute(query)
-                conn.commit()
-                return {"query": query, "status": "Executado com sucesso"}
+
+            return {"query": query, "status": "Executado com sucesso"}
     except sqlite3.Error as e:
         logger.error(f"Erro SQL: {e}")
         return {"erro": f"Erro ao executar SQL: {str(e)}", "query": query}
@@ -128,74 +290,256 @@ def executar_sql(query: str) -> Dict[str, Any]:
         return {"erro": f"Erro inesperado: {str(e)}", "query": query}
 
 
-def formatar_resultado(resultado: List[Any], colunas: Optional[List[str]] = None) -> str:
+# Escapa pipes nas células para evitar quebra de formatação
+_ESCAPE = str.maketrans({"|": "\\|", "\n": " "})
+
+
+def formatar_resultado(resultado: List[Any], colunas: Optional[Sequence[str]] = None) -> str:
     """Formata o resultado da consulta em tabela Markdown."""
     if not resultado:
         return "Nenhum resultado encontrado."
 
     LIMITE_RESULTADOS = 10
 
+    truncado = len(resultado) > LIMITE_RESULTADOS
+    if truncado:
+        resultado = resultado[:LIMITE_RESULTADOS]
+
     if isinstance(resultado[0], dict):
         colunas = list(resultado[0].keys())
-        linhas = [[str(item.get(c, "")) for c in colunas] for item in resultado]
+        linhas = [[item.get(c, "") for c in colunas] for item in resultado]
     else:
         if not colunas:
             colunas = [f"col{i+1}" for i in range(len(resultado[0]))]
-        linhas = [[str(c) for c in linha] for linha in resultado]
-
-    truncado = len(linhas) > LIMITE_RESULTADOS
-    if truncado:
-        linhas = linhas[:LIMITE_RESULTADOS]
-
-    # Escapa pipes nas células para evitar quebra de formatação
-    def escape_cell(cell: str) -> str:
-        return cell.replace("|", "\\|").replace("\n", " ")
+        linhas = resultado
 
-    tabela = "| " + " | ".join(escape_cell(c) for c in colunas) + " |\n"
-    tabela += "| " + " | ".join(["---"] * len(colunas)) + " |\n"
-    for linha in linhas:
-        tabela += "| " + " | ".join(escape_cell(str(c)) for c in linha) + " |\n"
+    separador = "| " + " | ".join("---" for _ in colunas) + " |"
+    partes = ["| " + " | ".join(c.translate(_ESCAPE) for c in colunas) + " |", separador]
+    partes.extend("| " + " | ".join(str(c).translate(_ESCAPE) for c in linha) + " |" for linha in linhas)
 
     if truncado:
-        tabela += f"\n⚠️ Mostrando apenas os primeiros {LIMITE_RESULTADOS} resultados."
+        partes.append(f"\n⚠️ Mostrando apenas os primeiros {LIMITE_RESULTADOS} resultados.")
+    else:
+        partes.append("")
 
-    return tabela
+    return "\n".join(partes)
 
 
 # ======================================================
 # 🧩 FUNÇÕES TOOL (executadas quando o modelo decide)
 # ======================================================
 
-def AI_SQL(pergunta: str) -> Dict[str, Any]:
-    """Converte linguagem natural em SQL via Ollama e executa a query."""
+# Bloco de código markdown contendo uma query SQL
+_SQL_RE = re.compile(r"```(?:sql)?\s*((?:SELECT|INSERT|UPDATE|DELETE)[^`]+)```", re.IGNORECASE)
+
+
+# Início de cada resposta numerada no modo em lote: "1.", "2)", "**1.**", "### 1."
+_ITEM_LOTE_RE = re.compile(r"^[ \t]*(?:#{1,6}[ \t]*)?(?:\*\*|__)?(\d+)[.)](?:\*\*|__)?[ \t]*", re.MULTILINE)
+
+# Prompt já renderizado para ollama.generate(raw=True); termina abrindo o bloco
+# SQL para que o stop em "```" corte a geração logo após a query
+_SQL_PROMPT_TEMPLATE = (
+    (BANCO_SCHEMA or "Você é um assistente SQL.").replace("{", "{{").replace("}", "}}")
+    + "\n\nPergunta: {q}\nSQL:\n```sql\n"
+)
+
+
+def _cache_key(schema_hash: str, pergunta: str) -> str:
+    return hashlib.sha256((schema_hash + pergunta).encode()).hexdigest()
+
+
+def _extrair_sql(conteudo: str) -> str:
+    """Extrai a query SQL da resposta do modelo."""
+    # Extrai SQL de blocos de código markdown; se não houver, usa o conteúdo direto
+    m = _SQL_RE.search(conteudo)
+    sql_query = (m.group(1) if m else conteudo).strip()
+    logger.info(f"SQL extraído{'' if m else ' (direto)'}: {sql_query}")
+    return sql_query
+
+
+# Cache LRU em memória na frente do banco de cache; ambos só recebem SQL já executada
+# com sucesso. Erros no cache são tratados como miss, sem falhar o /sql
+_CACHE_SQL: "OrderedDict[str, str]" = OrderedDict()
+CACHE_SQL_MAX = 512
+
+
+def ler_cache_sql(pergunta: str) -> Optional[str]:
+    """Retorna a SQL em cache para a pergunta do usuário, se houver."""
+    chave = _cache_key(BANCO_SCHEMA_HASH, pergunta)
+    with _CACHE_LOCK:
+        sql_query = _CACHE_SQL.get(chave)
+        if sql_query is None:
+            try:
+                linha = _CACHE_CONN.execute("SELECT sql FROM cache WHERE hash = ?", (chave,)).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Erro ao ler cache de SQL: {e}")
+                return None
+            if not linha:
+                return None
+            sql_query = linha[0]
+            _CACHE_SQL[chave] = sql_query
+            if len(_CACHE_SQL) > CACHE_SQL_MAX:
+                _CACHE_SQL.popitem(last=False)
+        _CACHE_SQL.move_to_end(chave)
+    logger.info(f"SQL recuperada do cache para pergunta: {pergunta[:50]}...")
+    return sql_query
+
+
+def gravar_cache_sql(pergunta: str, sql_query: str) -> None:
+    """Guarda a SQL da pergunta do usuário (memória e banco)."""
+    chave = _cache_key(BANCO_SCHEMA_HASH, pergunta)
+    with _CACHE_LOCK:
+        try:
+            _CACHE_CONN.execute("INSERT OR REPLACE INTO cache (hash, sql) VALUES (?, ?)", (chave, sql_query))
+        except sqlite3.Error as e:
+            logger.warning(f"Erro ao gravar cache de SQL: {e}")
+        _CACHE_SQL[chave] = sql_query
+        _CACHE_SQL.move_to_end(chave)
+        if len(_CACHE_SQL) > CACHE_SQL_MAX:
+            _CACHE_SQL.popitem(last=False)
+
+
+def _gerar_sql(pergunta: str) -> str:
+    """Gera a SQL de uma única pergunta via Ollama."""
+    resposta = ollama.generate(
+        model=OLLAMA_MODEL,
+        prompt=_SQL_PROMPT_TEMPLATE.format(q=pergunta),
+        raw=True,
+        options={**OLLAMA_OPTIONS, "num_predict": 256, "stop": ["```"]},
+        keep_alive=-1
+    )
+    conteudo = resposta["response"]
+    logger.info(f"Resposta Ollama recebida para pergunta: {pergunta[:50]}...")
+    return _extrair_sql(conteudo)
+
+
+def _gerar_sql_lote(perguntas: List[str]) -> List[Optional[str]]:
+    """Gera a SQL de várias perguntas numa única chamada ao Ollama.
+
+    Retorna uma SQL por pergunta, na mesma ordem; None quando a resposta
+    correspondente não pôde ser identificada.
+    """
+    sistema = (
+        (BANCO_SCHEMA or "Você é um assistente SQL especializado.")
+        + "\n\nResponda cada pergunta numerada com o mesmo número seguido "
+        "da query SQL em um bloco ```sql```."
+    )
+    enunciado = "\n".join(f"{i}. {p}" for i, p in enumerate(perguntas, 1))
+    resposta = ollama.chat(
+        model=OLLAMA_MODEL,
+        messages=[
+            {"role": "system", "content": sistema},
+            {"role": "user", "content": enunciado}
+        ],
+        options=OLLAMA_OPTIONS,
+        keep_alive=-1
+    )
+    conteudo = resposta["message"]["content"]
+    logger.info(f"Resposta Ollama recebida para lote de {len(perguntas)} perguntas")
+
+    # Só numeração fora de blocos ``` delimita itens (ex.: "2)" numa lista IN não conta)
+    marcadores = [
+        m for m in _ITEM_LOTE_RE.finditer(conteudo)
+        if conteudo.count("```", 0, m.start()) % 2 == 0
+    ]
+    sqls: List[Optional[str]] = [None] * len(perguntas)
+    for atual, proximo in zip(marcadores, marcadores[1:] + [None]):
+        texto = conteudo[atual.end():proximo.start() if proximo else len(conteudo)]
+        i = int(atual.group(1)) - 1
+        if 0 <= i < len(perguntas) and sqls[i] is None and _SQL_RE.search(texto):
+            sqls[i] = _extrair_sql(texto)
+    return sqls
+
+
+_FILA_SQL: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+# Chamadas em lote rodam fora do worker, que volta logo a atender a fila
+_EXECUTOR_LOTE = ThreadPoolExecutor(max_workers=2, thread_name_prefix="lote-sql")
+
+
+def submit_sql(pergunta: str) -> Future:
+    """Enfileira a pergunta para geração de SQL em lote.
+
+    O Future resolve para a SQL gerada, ou None quando a pergunta não entrou
+    num lote (nada mais na fila) ou a resposta não foi identificada; nesse
+    caso quem chamou gera a SQL individualmente, na própria thread.
+    """
+    future: Future = Future()
+    _FILA_SQL.put((pergunta, future))
+    return future
+
+
+def _worker_sql() -> None:
+    """Agrupa perguntas pendentes e despacha o lote para o executor.
+
+    Uma pergunta sozinha na fila é devolvida na hora (None) para ser gerada
+    pela thread do handler; o worker nunca espera uma chamada ao Ollama.
+    """
+    while True:
+        lote = [_FILA_SQL.get()]
+        if _FILA_SQL.empty():
+            lote[0][1].set_result(None)
+            continue
+
+        prazo = time.monotonic() + LOTE_SQL_JANELA
+        while len(lote) < LOTE_SQL_MAX:
+            restante = prazo - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(_FILA_SQL.get(timeout=restante))
+            except queue.Empty:
+                break
+
+        _EXECUTOR_LOTE.submit(_resolver_lote, lote)
+
+
+def _resolver_lote(lote: List[Tuple[str, Future]]) -> None:
+    perguntas = [p for p, _ in lote]
+    try:
+        sqls = _gerar_sql_lote(perguntas)
+    except Exception as e:
+        logger.error(f"Erro ao gerar SQL em lote: {e}")
+        sqls = [None] * len(lote)
+
+    for (_, future), sql_query in zip(lote, sqls):
+        future.set_result(sql_query)
+
+
+threading.Thread(target=_worker_sql, daemon=True, name="worker-sql").start()
+
+
+def invalidar_cache_sql(pergunta: str) -> None:
+    """Remove a SQL em cache de uma pergunta (memória e banco)."""
+    chave = _cache_key(BANCO_SCHEMA_HASH, pergunta)
+    with _CACHE_LOCK:
+        _CACHE_SQL.pop(chave, None)
+        try:
+            _CACHE_CONN.execute("DELETE FROM cache WHERE hash = ?", (chave,))
+        except sqlite3.Error as e:
+            logger.warning(f"Erro ao invalidar cache de SQL: {e}")
+
+
+def AI_SQL(pergunta: str, pergunta_cache: Optional[str] = None) -> Dict[str, Any]:
+    """Converte linguagem natural em SQL via Ollama e executa a query.
+
+    Se a execução der certo, a SQL é guardada no cache sob `pergunta_cache`
+    (a pergunta original do usuário) ou, na falta dela, sob `pergunta`.
+    SQL vinda de um lote não é guardada: a associação pela numeração da
+    resposta pode estar errada.
+    """
     if not BANCO_SCHEMA:
         logger.warning("BANCO_SCHEMA não configurado, usando contexto padrão")
     
     try:
-        resposta = ollama.chat(
-            model=OLLAMA_MODEL,
-            messages=[
-                {"role": "system", "content": BANCO_SCHEMA or "Você é um assistente SQL especializado."},
-                {"role": "user", "content": pergunta}
-            ]
-        )
-        conteudo = resposta["message"]["content"]
-        logger.info(f"Resposta Ollama recebida para pergunta: {pergunta[:50]}...")
-
-        # Extrai SQL de blocos de código markdown
-        if "```" in conteudo:
-            partes = conteudo.split("```")
-            for p in partes:
-                p_upper = p.upper()
-                if any(x in p_upper for x in ["SELECT", "INSERT", "UPDATE", "DELETE"]):
-                    sql_query = p.replace("sql", "").replace("SQL", "").strip()
-                    logger.info(f"SQL extraído: {sql_query}")
-                    return executar_sql(sql_query)
-        
-        # Se não encontrou SQL em blocos, tenta usar o conteúdo direto
-        sql_query = conteudo.strip()
-        logger.info(f"SQL extraído (direto): {sql_query}")
-        return executar_sql(sql_query)
+        sql_query = submit_sql(pergunta).result()
+        do_lote = sql_query is not None
+        if not do_lote:
+            # Sem lote (ou resposta não identificada nele): gera individualmente
+            sql_query = _gerar_sql(pergunta)
+        resultado = executar_sql(sql_query)
+        if "erro" not in resultado and not do_lote:
+            gravar_cache_sql(pergunta_cache or pergunta, sql_query)
+        return resultado
     
     except Exception as e:
         logger.error(f"Erro em AI_SQL: {e}")
@@ -225,20 +569,56 @@ TOOLS = [
 # 🧠 PROCESSAMENTO COM TOOLS (Ollama decide automaticamente)
 # ======================================================
 
-def processar_com_tools(pergunta: str) -> Dict[str, Any]:
-    """Processa a pergunta com o Ollama e executa tool automaticamente."""
+def processar_com_tools(
+    pergunta: str,
+    usar_cache: bool = True,
+    ao_receber: Optional[Callable[[str], None]] = None
+) -> Dict[str, Any]:
+    """Processa a pergunta com o Ollama e executa tool automaticamente.
+
+    Se `ao_receber` for informado, é chamado periodicamente com o texto
+    parcial gerado até o momento. Com `usar_cache`, uma pergunta já
+    respondida executa direto a SQL guardada, sem passar pelo Ollama.
+    """
+    if not usar_cache:
+        invalidar_cache_sql(pergunta)
+    else:
+        sql_query = ler_cache_sql(pergunta)
+        if sql_query is not None:
+            resultado = executar_sql(sql_query)
+            if "erro" not in resultado:
+                return resultado
+            # SQL guardada deixou de funcionar (ex.: schema mudou): gera de novo
+            invalidar_cache_sql(pergunta)
+
     messages = [
         {"role": "system", "content": BACKGROUND or "Você é um assistente útil."},
         {"role": "user", "content": pergunta}
     ]
 
-    resposta = ""
+    resposta_parts: List[str] = []
+    tokens_pendentes = 0
+    ultima_edicao = time.monotonic()
     try:
-        for chunk in ollama.chat(model=OLLAMA_MODEL, messages=messages, tools=TOOLS, stream=True):
-            if "message" in chunk and "content" in chunk["message"]:
-                resposta += chunk["message"]["content"]
-            if "message" in chunk and "tool_calls" in chunk["message"]:
-                for call in chunk["message"]["tool_calls"]:
+        for chunk in ollama.chat(
+            model=OLLAMA_MODEL, messages=messages, tools=TOOLS, stream=True,
+            options=OLLAMA_OPTIONS, keep_alive=-1
+        ):
+            m = chunk.get("message") or {}
+            if (c := m.get("content")):
+                resposta_parts.append(c)
+                tokens_pendentes += 1
+                agora = time.monotonic()
+                if ao_receber and (
+                    tokens_pendentes >= STREAM_EDIT_TOKENS or agora - ultima_edicao >= STREAM_EDIT_INTERVALO
+                ):
+                    parcial = "".join(resposta_parts)
+                    if parcial.strip():
+                        ao_receber(parcial)
+                        tokens_pendentes = 0
+                        ultima_edicao = agora
+            if (tc := m.get("tool_calls")):
+                for call in tc:
                     nome = call["function"]["name"]
                     args = call["function"].get("arguments", "{}")
                     if isinstance(args, str):
@@ -252,9 +632,10 @@ def processar_com_tools(pergunta: str) -> Dict[str, Any]:
                         pergunta_sql = args.get("pergunta", "")
                         if not pergunta_sql:
                             return {"erro": "Pergunta não fornecida para ExecSql"}
-                        return AI_SQL(pergunta_sql)
+                        return AI_SQL(pergunta_sql, pergunta_cache=pergunta)
 
-        return {"resposta": resposta.strip() if resposta.strip() else "Sem resposta gerada"}
+        resposta = "".join(resposta_parts).strip()
+        return {"resposta": resposta or "Sem resposta gerada"}
     
     except Exception as e:
         logger.error(f"Erro em processar_com_tools: {e}")
@@ -264,6 +645,60 @@ def processar_com_tools(pergunta: str) -> Dict[str, Any]:
 # 🤖 BOT TELEGRAM
 # ======================================================
 
+def _retry_after(e: telebot.apihelper.ApiTelegramException) -> float:
+    """Segundos de espera pedidos pelo Telegram num erro 429."""
+    parametros = (e.result_json or {}).get("parameters") or {}
+    return float(parametros.get("retry_after", 1))
+
+
+def editar_mensagem(sent, texto: str, **kwargs) -> None:
+    """Atualiza uma mensagem já enviada pelo bot com o texto final.
+
+    Respeita o retry_after em caso de 429; se a edição continuar falhando,
+    envia o texto como nova mensagem no mesmo chat.
+    """
+    for tentativa in range(EDIT_TENTATIVAS):
+        try:
+            bot.edit_message_text(texto, chat_id=sent.chat.id, message_id=sent.message_id, **kwargs)
+            return
+        except telebot.apihelper.ApiTelegramException as e:
+            if "message is not modified" in str(e):
+                return
+            if e.error_code != 429 or tentativa == EDIT_TENTATIVAS - 1:
+                logger.warning(f"Falha ao editar mensagem, enviando nova: {e}")
+                break
+            espera = _retry_after(e)
+            logger.warning(f"Rate limit do Telegram ao editar mensagem, aguardando {espera}s")
+            time.sleep(espera)
+    bot.send_message(sent.chat.id, texto, **kwargs)
+
+
+def editor_parcial(sent) -> Callable[[str], None]:
+    """Cria o callback das atualizações parciais (melhor esforço).
+
+    Após um 429 as edições são puladas até passar o retry_after; qualquer
+    erro é apenas registrado, sem interromper a geração.
+    """
+    bloqueado_ate = 0.0
+
+    def editar(texto: str) -> None:
+        nonlocal bloqueado_ate
+        if time.monotonic() < bloqueado_ate:
+            return
+        try:
+            bot.edit_message_text(texto, chat_id=sent.chat.id, message_id=sent.message_id)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                bloqueado_ate = time.monotonic() + _retry_after(e)
+                logger.warning(f"Rate limit do Telegram, edições parciais pausadas: {e}")
+            elif "message is not modified" not in str(e):
+                logger.warning(f"Erro ao editar mensagem parcial: {e}")
+        except Exception as e:
+            logger.warning(f"Erro ao editar mensagem parcial: {e}")
+
+    return editar
+
+
 @bot.message_handler(commands=["start"])
 def start_cmd(msg):
     bot.reply_to(msg, (
@@ -277,163 +712,217 @@ def start_cmd(msg):
 @bot.message_handler(commands=["sql"])
 def sql_cmd(msg):
     pergunta = msg.text.replace("/sql", "").strip()
+    usar_cache = "--nocache" not in pergunta
+    pergunta = pergunta.replace("--nocache", "").strip()
     if not pergunta:
         bot.reply_to(msg, "Envie algo como: `/sql quantos usuários existem?`", parse_mode="Markdown")
         return
 
+    sent = None
     try:
-        resultado = seguro_json(processar_com_tools(pergunta))
+        # Mensagem provisória, atualizada conforme o Ollama gera a resposta
+        sent = bot.reply_to(msg, "…")
+        resultado = seguro_json(processar_com_tools(
+            pergunta, usar_cache, ao_receber=editor_parcial(sent)
+        ))
         logger.info(f"Resultado processado para usuário {msg.from_user.id}: {type(resultado)}")
 
         # Caso o resultado seja um dicionário retornado pelo executar_sql
         if isinstance(resultado, dict):
             if "erro" in resultado:
-                bot.reply_to(msg, f"❌ Erro: {resultado['erro']}")
+                editar_mensagem(sent, f"❌ Erro: {resultado['erro']}")
             elif "resultado" in resultado:
                 tabela = formatar_resultado(resultado["resultado"], resultado.get("colunas"))
-                bot.reply_to(
-                    msg,
+                editar_mensagem(
+                    sent,
                     f"✅ *Query:* `{resultado.get('query', '')}`\n\n📊 *Resultado:*\n{tabela}",
                     parse_mode="Markdown"
                 )
             elif "status" in resultado:
-                bot.reply_to(
-                    msg,
+                editar_mensagem(
+                    sent,
                     f"✅ {resultado['status']}\nQuery: `{resultado.get('query', '')}`",
                     parse_mode="Markdown"
                 )
             elif "resposta" in resultado:
-                bot.reply_to(msg, resultado["resposta"])
+                editar_mensagem(sent, resultado["resposta"])
             else:
                 logger.warning(f"Retorno inesperado: {resultado}")
-                bot.reply_to(msg, f"ℹ️ Retorno inesperado: {resultado}")
+                editar_mensagem(sent, f"ℹ️ Retorno inesperado: {resultado}")
 
         elif isinstance(resultado, str):
-            bot.reply_to(msg, resultado)
+            editar_mensagem(sent, resultado)
         else:
             logger.warning(f"Tipo de retorno não reconhecido: {type(resultado)}")
-            bot.reply_to(msg, f"⚠️ Tipo de retorno não reconhecido: {type(resultado)}")
+            editar_mensagem(sent, f"⚠️ Tipo de retorno não reconhecido: {type(resultado)}")
 
     except Exception as e:
         logger.error(f"Erro em sql_cmd: {e}", exc_info=True)
-        bot.reply_to(msg, f"❌ Erro: {e}")
+        try:
+            # Substitui o "…" provisório; reply_to só se nem ele chegou a ser enviado
+            if sent is not None:
+                editar_mensagem(sent, f"❌ Erro: {e}")
+            else:
+                bot.reply_to(msg, f"❌ Erro: {e}")
+        except Exception as e2:
+            logger.error(f"Erro ao enviar mensagem de erro: {e2}")
+
+
+
+def transcrever(audio: np.ndarray) -> str:
+    """Transcreve o áudio, truncado em VOZ_DURACAO_MAXIMA segundos.
 
+    O faster-whisper já decodifica em janelas de 30 s mantendo o contexto
+    entre elas, então o áudio é passado inteiro.
+    """
+    audio = audio[:TAXA_AMOSTRAGEM * VOZ_DURACAO_MAXIMA]
+    segments, _ = get_asr().transcribe(audio, beam_size=1, vad_filter=True)
+    return " ".join(s.text for s in segments).strip()
 
 
 @bot.message_handler(content_types=['voice'])
 def handle_voice(msg):
-    ogg_path = None
-    wav_path = None
-    
+    # 🔹 Toques acidentais no microfone: nem baixa o áudio
+    if msg.voice.duration < VOZ_DURACAO_MINIMA:
+        bot.reply_to(msg, "⚠️ Áudio muito curto.")
+        return
+
     try:
         # 🔹 Baixa o arquivo do Telegram
         file_info = bot.get_file(msg.voice.file_id)
         downloaded_file = bot.download_file(file_info.file_path)
 
-        # 🔹 Cria arquivos temporários
-        with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as tmp_ogg:
-            ogg_path = tmp_ogg.name
-            tmp_ogg.write(downloaded_file)
-
-        wav_path = ogg_path.replace('.ogg', '.wav')
-
         # 🔹 Caminho do ffmpeg dentro do venv
         ffmpeg_path = ffmpeg.get_ffmpeg_exe()
 
+        # 🔹 Decodifica OGG -> PCM int16 16 kHz mono direto pelo pipe (até o limite de duração)
         command = [
             ffmpeg_path,
-            '-y',
-            '-i', ogg_path,
+            '-v', 'error',
+            '-i', 'pipe:0',
+            '-t', str(VOZ_DURACAO_MAXIMA),
+            '-f', 's16le',
             '-ac', '1',
-            '-ar', '16000',
-            wav_path
+            '-ar', str(TAXA_AMOSTRAGEM),
+            'pipe:1'
         ]
 
         # 🔹 Executa ffmpeg
         process = subprocess.run(
             command,
+            input=downloaded_file,
             capture_output=True,
-            text=True
+            check=True,
+            timeout=FFMPEG_TIMEOUT
         )
 
-        # 🔹 Verifica saída e erros
-        if process.returncode != 0:
-            logger.error(f"Erro ao executar ffmpeg: {process.stderr}")
-            bot.reply_to(msg, f"❌ Erro ao converter áudio:\n{process.stderr[:200]}")
+        # 🔹 int16 -> float32 em [-1, 1], vetorizado e sem passar por float64
+        audio = np.frombuffer(process.stdout, dtype=np.int16).astype(np.float32)
+        audio *= np.float32(1.0 / 32768.0)
+        if audio.size == 0:
+            logger.error("ffmpeg não retornou amostras de áudio")
+            bot.reply_to(msg, "❌ Erro: Áudio não foi decodificado corretamente.")
             return
 
         logger.info("Conversão de áudio concluída com sucesso")
 
-        # 🔹 Garante que o ffmpeg está no PATH antes de usar o Whisper
-        if FFMPEG_DIR and FFMPEG_DIR not in os.environ.get("PATH", ""):
-            os.environ["PATH"] = FFMPEG_DIR + os.pathsep + os.environ.get("PATH", "")
-            logger.info(f"ffmpeg adicionado ao PATH para Whisper: {FFMPEG_DIR}")
-        
-        # Verifica se o arquivo WAV existe e tem tamanho válido
-        if not os.path.exists(wav_path) or os.path.getsize(wav_path) == 0:
-            logger.error(f"Arquivo WAV inválido ou vazio: {wav_path}")
-            bot.reply_to(msg, "❌ Erro: Arquivo de áudio não foi criado corretamente.")
+        # 🔹 Silêncio: evita a passagem pelo encoder do Whisper
+        if np.sqrt(np.mean(np.square(audio))) < VOZ_RMS_MINIMO:
+            bot.reply_to(msg, "⚠️ Não foi possível transcrever o áudio (áudio vazio ou sem fala).")
             return
 
-        # 🔹 Transcreve o WAV com Whisper
+        # 🔹 Transcreve o áudio com Whisper
         try:
-            logger.info(f"Iniciando transcrição do arquivo: {wav_path}")
-            result = model.transcribe(wav_path, fp16=False)
-            texto = result["text"].strip()
+            logger.info(f"Iniciando transcrição de {audio.size / TAXA_AMOSTRAGEM:.1f}s de áudio")
+            texto = transcrever(audio)
             logger.info("Transcrição concluída com sucesso")
 
             if not texto:
                 bot.reply_to(msg, "⚠️ Não foi possível transcrever o áudio (áudio vazio ou sem fala).")
             else:
+                if msg.voice.duration > VOZ_DURACAO_MAXIMA:
+                    texto += f"\n\n⚠️ Transcritos apenas os primeiros {VOZ_DURACAO_MAXIMA} s."
                 # 🔹 Responde a transcrição
                 bot.reply_to(msg, f"🗣️ Transcrição: {texto}")
-        except FileNotFoundError as e:
-            logger.error(f"WinError 2 - Arquivo não encontrado: {e}")
-            logger.error(f"ffmpeg_path: {FFMPEG_EXE if FFMPEG_EXE else 'N/A'}")
-            logger.error(f"ffmpeg_dir: {FFMPEG_DIR if FFMPEG_DIR else 'N/A'}")
-            logger.error(f"PATH atual (primeiros 300 chars): {os.environ.get('PATH', '')[:300]}...")
-            logger.error(f"Arquivo WAV existe: {os.path.exists(wav_path) if wav_path else 'N/A'}")
-            bot.reply_to(msg, "❌ Erro: ffmpeg não encontrado. O Whisper precisa do ffmpeg no PATH do sistema.")
         except Exception as e:
             logger.error(f"Erro ao transcrever com Whisper: {e}", exc_info=True)
             bot.reply_to(msg, f"❌ Erro ao transcrever áudio: {e}")
 
+    except FileNotFoundError as e:
+        logger.error(f"WinError 2 - Arquivo não encontrado: {e}")
+        logger.error(f"ffmpeg_path: {FFMPEG_EXE if FFMPEG_EXE else 'N/A'}")
+        logger.error(f"ffmpeg_dir: {FFMPEG_DIR if FFMPEG_DIR else 'N/A'}")
+        bot.reply_to(msg, "❌ Erro: ffmpeg não encontrado.")
+    except subprocess.TimeoutExpired:
+        logger.error(f"ffmpeg excedeu {FFMPEG_TIMEOUT}s ao converter áudio")
+        bot.reply_to(msg, "❌ Erro: conversão de áudio demorou demais.")
     except subprocess.CalledProcessError as e:
-        logger.error(f"Erro FFmpeg (CalledProcessError): {e}")
-        error_msg = e.stderr if hasattr(e, 'stderr') and e.stderr else str(e)
+        # Só o final do stderr interessa para o log
+        error_msg = e.stderr[-4096:].decode(errors="replace") if e.stderr else str(e)
+        logger.error(f"Erro FFmpeg (CalledProcessError): {e}\n{error_msg}")
         bot.reply_to(msg, f"❌ Erro FFmpeg:\n{error_msg[:200]}")
     except Exception as e:
         logger.error(f"Erro ao processar áudio: {e}", exc_info=True)
         bot.reply_to(msg, f"❌ Erro ao processar áudio: {e}")
-    finally:
-        # 🔹 Limpa os arquivos temporários
-        for path in [ogg_path, wav_path]:
-            if path and os.path.exists(path):
-                try:
-                    os.remove(path)
-                except Exception as e:
-                    logger.warning(f"Erro ao remover arquivo temporário {path}: {e}")
 
 
 
 # ======================================================
-# 🏁 EXECUÇÃO COM UVICORN + THREAD DO BOT
+# 🌐 WEBHOOK / POLLING TELEGRAM
 # ======================================================
 
 def run_bot():
     try:
+        bot.remove_webhook()
         bot.polling(non_stop=True, interval=0, timeout=20)
     except Exception as e:
         logger.error(f"Erro no bot do Telegram: {e}", exc_info=True)
 
 
+@app.on_event("startup")
+def iniciar_bot():
+    if PUBLIC_URL:
+        try:
+            bot.remove_webhook()
+            bot.set_webhook(url=PUBLIC_URL + "/tg", secret_token=WEBHOOK_SECRET)
+            logger.info(f"Webhook do Telegram registrado em {PUBLIC_URL}/tg")
+        except Exception as e:
+            logger.error(f"Erro ao registrar webhook do Telegram: {e}", exc_info=True)
+    else:
+        # Sem URL pública: polling em thread separada (desenvolvimento local)
+        logger.warning("PUBLIC_URL não configurada, usando polling do Telegram")
+        threading.Thread(target=run_bot, daemon=True).start()
+
+
+@app.post("/tg")
+async def tg(req: Request):
+    segredo = req.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    # Compara bytes: str com caracteres não-ASCII faria compare_digest levantar TypeError
+    if not hmac.compare_digest(segredo.encode(), WEBHOOK_SECRET.encode()):
+        raise HTTPException(status_code=403)
+    # O TeleBot é threaded: os handlers rodam no pool do bot, sem bloquear o event loop
+    bot.process_new_updates([telebot.types.Update.de_json(await req.json())])
+    return {"ok": True}
+
+
+# ======================================================
+# 🏁 EXECUÇÃO COM UVICORN
+# ======================================================
+
 if __name__ == "__main__":
     try:
-        # Inicia o bot em thread separada
-        bot_thread = threading.Thread(target=run_bot, daemon=True)
-        bot_thread.start()      
-        # Inicia o servidor FastAPI
-        uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True, reload_dirs=["."])
+        # Com polling, cada worker consultaria o Telegram: força um único worker
+        workers = WORKERS if PUBLIC_URL else 1
+        # Reload e vários workers exigem "app:app"; num único processo, passar o objeto
+        # evita importar o módulo de novo (conexão SQLite, worker-sql, etc.)
+        uvicorn.run(
+            "app:app" if RELOAD or workers > 1 else app,
+            host="0.0.0.0",
+            port=8000,
+            reload=RELOAD,
+            reload_dirs=["."] if RELOAD else None,
+            workers=workers
+        )
     except KeyboardInterrupt:
         logger.info("Servidor encerrado pelo usuário")
     except Exception as e: